@@ -1,7 +1,6 @@
 import os
 import pandas as pd
 import numpy as np
-import torch
 import re
 import string
 
@@ -9,7 +8,7 @@ from collections import defaultdict
 from pathlib import Path
 
 from modules.config import load_cmd_line, COLOR_LIST
-from modules.utils import read_json, clean_df, get_project_root, get_topn
+from modules.utils import read_json, clean_df, get_project_root, get_topn, load_saved_weights
 
 
 def acquire_news_info(imp_index, item_index, prefix="history"):
@@ -93,7 +92,7 @@ if __name__ == "__main__":
     saved_dir = project_root / "saved"
     weight_dir = saved_dir / "models" / "MIND15" / "RS_BATM_base_att_small_base_tanh_hd30_20221107-223130" / "weight"
     weight_dir = Path(cmd_args.get('weight_dir', weight_dir))
-    weight_dict = torch.load(weight_dir / f"{topic_num}.pt")
+    weight_dict = load_saved_weights(weight_dir / f"{topic_num}.npz")
     impression_index = weight_dict["impression_index"]
     selected_index = cmd_args.get("selected_imp", None)
     if selected_index:
@@ -36,14 +36,17 @@ class NRDataLoader:
         self.tokenizer = Tokenizer(**kwargs)
         bs = kwargs.get("batch_size", 64)
         impression_bs = kwargs.get("impression_batch_size", 1)
+        num_workers = kwargs.get("num_workers", 0)
+        loader_kwargs = {"pin_memory": True, "num_workers": num_workers, "persistent_workers": num_workers > 0}
         self.fn = collate_fn
         module_dataset_name = kwargs.get("dataset_class", "NewsRecDataset")
         self.train_set = getattr(module_dataset, module_dataset_name)(self.tokenizer, phase="train", **kwargs)
-        self.train_loader = DataLoader(self.train_set, bs, pin_memory=True, collate_fn=self.fn)
+        self.train_loader = DataLoader(self.train_set, bs, collate_fn=self.fn, **loader_kwargs)
         # setup news and user dataset
         self.valid_set = getattr(module_dataset, module_dataset_name)(self.tokenizer, phase="valid", **kwargs)
         self.test_set = getattr(module_dataset, module_dataset_name)(self.tokenizer, phase="test", **kwargs)
         news_set = NewsDataset(self.train_set)
-        self.news_loader = DataLoader(news_set, kwargs.get("news_batch_size", 128))
-        self.valid_loader = DataLoader(ImpressionDataset(self.valid_set), impression_bs, collate_fn=self.fn)
+        self.news_loader = DataLoader(news_set, kwargs.get("news_batch_size", 128), **loader_kwargs)
+        self.valid_loader = DataLoader(ImpressionDataset(self.valid_set), impression_bs, collate_fn=self.fn,
+                                       **loader_kwargs)
         self.word_dict = self.tokenizer.word_dict
@@ -126,7 +126,8 @@ with torch.no_grad():
         news_loader = DataLoader(data_loader.valid_set, config.batch_size)
         news_embeds = get_news_embeds(trainer.model, news_loader=data_loader.news_loader, device=trainer.device,
                                       accelerator=trainer.accelerator, num_processes=config.get("num_processes", 2))
-    except KeyError or RuntimeError:  # slow evaluation: re-calculate news embeddings every time
+    except (KeyError, RuntimeError) as e:  # slow evaluation: re-calculate news embeddings every time
+        logger.warning(f"Fast evaluation is skipped and falls back to slow evaluation: {e!r}")
         news_embeds = None
 
 news_texts = data_loader.valid_set.news_behavior.news_features["title"]
@@ -148,11 +149,13 @@ with torch.no_grad():
         out_dict = model(batch_dict)    # run model
         pred = out_dict["pred"].cpu().numpy()
         can_len = batch_dict["candidate_length"].cpu().numpy()
+        # copy the whole batch to host once instead of once per impression
+        batch_can_news = batch_dict["candidate_news"].cpu().numpy()
+        batch_can_index = batch_dict["candidate_index"].cpu().numpy()
         for i in range(len(pred)):
             if can_len[i] > 10:
-                index = batch_dict["impression_index"][i].cpu().tolist()  # record impression index
-                can_news = batch_dict["candidate_news"][i].cpu().numpy()
-                can_index = batch_dict["candidate_index"][i].cpu().numpy()
+                can_news = batch_can_news[i]
+                can_index = batch_can_index[i]
                 scores = pred[i][:can_len[i]]
                 can_news_all = torch.FloatTensor(can_news[:can_len[i]])
                 top10_cans_indices = top_n_indices(scores, 10)
@@ -54,7 +54,8 @@ if __name__ == "__main__":
             news_loader = DataLoader(news_set, config.batch_size)
             news_embeds = get_news_embeds(trainer.model, news_loader=news_loader, device=trainer.device,
                                           accelerator=trainer.accelerator, num_processes=config.get("num_processes", 2))
-        except KeyError or RuntimeError:  # slow evaluation: re-calculate news embeddings every time
+        except (KeyError, RuntimeError) as e:  # slow evaluation: re-calculate news embeddings every time
+            logger.warning(f"Fast evaluation is skipped and falls back to slow evaluation: {e!r}")
             news_embeds = None
         impression_set = module_dataset.ImpressionDataset(test_set, news_embeds)
         test_loader = DataLoader(impression_set, impression_bs, collate_fn=collate_fn)
@@ -63,8 +64,8 @@ if __name__ == "__main__":
             batch_dict = load_batch_data(batch_dict, trainer.device)
             pred = trainer.model(batch_dict)["pred"].cpu().numpy()
             can_len = batch_dict["candidate_length"].cpu().numpy()
-            for i in range(len(pred)):
-                index = batch_dict["impression_index"][i].cpu().tolist()  # record impression index
+            imp_indices = batch_dict["impression_index"].cpu().tolist()  # record impression index
+            for i, index in enumerate(imp_indices):
                 result_dict[index] = pred[i][:can_len[i]]
     with open(Path(saved_dir, saved_name, f"{saved_filename}.txt"), 'w') as f:  # saved predictions as txt file
         for impr_index, preds in tqdm(result_dict.items(), total=len(result_dict), desc="Writing"):
@@ -1,3 +1,4 @@
+import math
 import torch
 import numpy as np
 import torch.nn.functional as F
@@ -53,11 +54,30 @@ class TopicLayer(nn.Module):
         else:
             raise ValueError("Specify correct variant name!")
 
+    def fused_topic_vec(self, news_embeddings, news_mask):
+        """
+        Compute the weighted sum of news embeddings (topic_weight @ news_embeddings) of the base variant with
+        scaled dot product attention, which fuses masking, softmax and matmul into one kernel.
+        The weights of the last linear layer act as topic queries and the hidden states as keys,
+        its bias is constant along the sequence and cancels out in softmax.
+        """
+        hidden = self.topic_layer[:-1](news_embeddings)  # (N, S, D)
+        # SDPA scales by 1/sqrt(D), scale queries back to keep the original logits
+        query = self.topic_layer[-1].weight * math.sqrt(hidden.size(-1))  # (H, D)
+        query = query.expand(news_embeddings.size(0), -1, -1)  # (N, H, D)
+        valid = news_mask.unsqueeze(1) != 0  # (N, 1, S)
+        attn_mask = torch.zeros_like(valid, dtype=hidden.dtype).masked_fill(~valid, -1e4)
+        topic_vec = F.scaled_dot_product_attention(query, hidden, news_embeddings, attn_mask=attn_mask)
+        return topic_vec * valid.any(dim=-1, keepdim=True)  # news without any valid token gets zero vectors
+
     def forward(self, news_embeddings, news_mask, **kwargs):
         """
         Topic forward pass, return topic vector and topic weights
+        set return_topic_weight to False to skip materializing topic weights (only for the base variant)
         """
-        mask = news_mask.expand(self.head_num, news_embeddings.size(0), -1).transpose(0, 1) == 0
+        if self.variant_name == "base" and not kwargs.get("return_topic_weight", True):
+            return {"topic_vec": self.final(self.fused_topic_vec(news_embeddings, news_mask))}  # (N, H, E)
+        mask = news_mask.unsqueeze(1) == 0  # (N, 1, S), broadcast to (N, H, S) in masked_fill
         out_dict = {}
         if self.variant_name == "topic_embed":
             # topic_weight = self.topic_layer(kwargs.get("news")).transpose(1, 2)  # (N, H, S)
@@ -94,7 +114,6 @@ class TopicLayer(nn.Module):
             topic_weight = torch.softmax(topic_weight.masked_fill(mask, -1e4), dim=-1).masked_fill(mask, 0)
         else:
             topic_weight = self.topic_layer(news_embeddings).transpose(1, 2)  # (N, H, S)
-            # expand mask to the same size as topic weights
             # fill zero entry with -INF when doing softmax and fill in zeros after that
             topic_weight = torch.softmax(topic_weight.masked_fill(mask, -1e4), dim=-1).masked_fill(mask, 0)
             # topic_weight = torch.softmax(topic_weight, dim=1).masked_fill(mask, 0)  # external attention
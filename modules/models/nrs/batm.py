@@ -27,9 +27,17 @@ class BATMRSModel(MindNRSBase):
             self.topic_att = AttLayer(self.embedding_dim * 2, self.attention_hidden_dim)
             self.topic_affine = nn.Linear(self.embedding_dim * 2, self.embedding_dim)
             # self.multi_att = AttLayer(self.embedding_dim, self.attention_hidden_dim)
+        # user encoder is fixed after construction, bind it once instead of branching in every forward pass
+        if self.user_history_connect == "concat":
+            self.user_encoder = self._user_encoder_concat
+        else:
+            self.user_encoder = getattr(self, f"_user_encoder_{self.user_encoder_name}", self._user_encoder_base)
 
     def extract_topic(self, input_feat):
         input_feat["news_embeddings"] = self.dropouts(self.embedding_layer(**input_feat))
+        # topic weights are only materialized when they are used (entropy, returned weights or topic evaluation)
+        input_feat["return_topic_weight"] = (self.return_weight or self.with_entropy or self.show_entropy
+                                             or input_feat.get("evaluate_topic", False))
         return self.topic_layer(**input_feat)
 
     def news_encoder(self, input_feat):
@@ -49,31 +57,37 @@ class BATMRSModel(MindNRSBase):
                 input_feat["news"] = input_feat["news"].reshape(news_shape).reshape(news_shape[0], -1)
                 input_feat["news_mask"] = input_feat["news_mask"].reshape(news_shape).reshape(news_shape[0], -1).bool()
             topic_dict = self.extract_topic(input_feat)
-            topic_weight = topic_dict["topic_weight"]
+            topic_weight = topic_dict.get("topic_weight", None)
             # add activation function
             news_vector, news_weight = self.news_att_layer(self.dropouts(topic_dict["topic_vec"]))
-        out_dict = {"news_embed": news_vector, "news_weight": news_weight.squeeze(-1), "topic_weight": topic_weight}
+        out_dict = {"news_embed": news_vector, "news_weight": news_weight.squeeze(-1)}
+        if topic_weight is not None:
+            out_dict["topic_weight"] = topic_weight
         if self.topic_variant == "variational_topic":
             out_dict["kl_divergence"] = topic_dict["kl_divergence"]
         return out_dict
 
-    def user_encoder(self, input_feat):
+    def _user_encoder_concat(self, input_feat):
+        return {"user_embed": input_feat["history_news"], "user_weight": None}
+
+    def _user_encoder_gru(self, input_feat):
         history_news = input_feat["history_news"]
-        if self.user_history_connect == "concat":
-            return {"user_embed": history_news, "user_weight": None}
-        if self.user_encoder_name == "gru":
-            history_length = input_feat["history_length"].cpu()
-            packed_y = pack_padded_sequence(history_news, history_length, batch_first=True, enforce_sorted=False)
-            user_vector = self.user_encode_layer(packed_y)[1].squeeze(dim=0)
-            user_weight = None
-            # y = self.user_encode_layer(history_news)[0]
-            # user_vector, user_weight = self.user_att_layer(y)  # additive attention layer
-        elif self.user_encoder_name == "batm":
-            user_weight = self.user_encode_layer(history_news).transpose(1, 2)
-            # mask = input_feat["news_mask"].expand(self.head_num, y.size(0), -1).transpose(0, 1) == 0
-            # user_weight = torch.softmax(user_weight.masked_fill(mask, 0), dim=-1)  # fill zero entry with zero weight
-            user_vec = self.user_final(torch.matmul(user_weight, history_news))
-            user_vector, user_weight = self.user_att_layer(user_vec)  # additive attention layer
-        else:
-            user_vector, user_weight = self.user_att_layer(history_news)  # additive attention layer
+        history_length = input_feat["history_length"].cpu()
+        packed_y = pack_padded_sequence(history_news, history_length, batch_first=True, enforce_sorted=False)
+        user_vector = self.user_encode_layer(packed_y)[1].squeeze(dim=0)
+        # y = self.user_encode_layer(history_news)[0]
+        # user_vector, user_weight = self.user_att_layer(y)  # additive attention layer
+        return {"user_embed": user_vector, "user_weight": None}
+
+    def _user_encoder_batm(self, input_feat):
+        history_news = input_feat["history_news"]
+        user_weight = self.user_encode_layer(history_news).transpose(1, 2)
+        # mask = input_feat["news_mask"].unsqueeze(1) == 0  # (N, 1, S), broadcast over heads
+        # user_weight = torch.softmax(user_weight.masked_fill(mask, 0), dim=-1)  # fill zero entry with zero weight
+        user_vec = self.user_final(torch.matmul(user_weight, history_news))
+        user_vector, user_weight = self.user_att_layer(user_vec)  # additive attention layer
+        return {"user_embed": user_vector, "user_weight": user_weight}
+
+    def _user_encoder_base(self, input_feat):
+        user_vector, user_weight = self.user_att_layer(input_feat["history_news"])  # additive attention layer
         return {"user_embed": user_vector, "user_weight": user_weight}
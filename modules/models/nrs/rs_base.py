@@ -127,10 +127,36 @@ class MindNRSBase(BaseModel):
                 input_feat["kl_divergence"] += news_dict["kl_divergence"]
         return input_feat
 
+    def load_news_cache(self, input_feat, run_name):
+        """
+        gather news vectors (and weights) from the precomputed cache instead of re-running the news encoder
+        :param input_feat: should include news_cache, a dictionary of tensors indexed by news index
+        :param run_name: candidate or history
+        :return: input_feat with the gathered news vectors
+        """
+        news_cache, indices = input_feat["news_cache"], input_feat[f"{run_name}_index"]
+        batch_size = indices.size(0)
+        news_dict = {
+            key: torch.index_select(cache, 0, indices.reshape(-1)).float() for key, cache in news_cache.items()
+        }  # each output with shape [N * C, ...], cache may be stored in lower precision
+        news_shape = (batch_size, -1, news_dict["news_embed"].size(-1))
+        input_feat[f"{run_name}_news"] = reshape_tensor(news_dict["news_embed"], output_shape=news_shape)
+        if self.return_weight and "news_weight" in news_dict:
+            weight_shape = (batch_size, -1, news_dict["news_weight"].size(1))
+            input_feat[f"{run_name}_weight"] = reshape_tensor(news_dict["news_weight"], output_shape=weight_shape)
+            if "topic_weight" in news_dict:
+                topic_weight = news_dict["topic_weight"]
+                shape = (batch_size, -1, topic_weight.size(-2), topic_weight.size(-1))
+                input_feat[f"{run_name}_topic_weight"] = reshape_tensor(topic_weight, output_shape=shape)
+        return input_feat
+
     def acquire_news_dict(self, input_feat):
         for tensor_name in self.reshape_tensors:
             if tensor_name in input_feat:
                 input_feat[tensor_name] = reshape_tensor(input_feat[tensor_name])
+        if "news_cache" in input_feat:  # news encoder outputs are precomputed, only gather them by index
+            input_feat = self.load_news_cache(input_feat, "candidate")
+            return self.load_news_cache(input_feat, "history")
         if "candidate_news" not in input_feat or self.return_weight or self.with_entropy:
             # pass news embeddings cache or return weight
             input_feat = self.run_news_encoder(input_feat, "candidate")
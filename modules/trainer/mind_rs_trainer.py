@@ -1,4 +1,3 @@
-import copy
 import math
 import os
 from collections import defaultdict
@@ -6,7 +5,6 @@ from pathlib import Path
 import wandb
 import torch
 import torch.distributed
-import pandas as pd
 import numpy as np
 from torch.utils.data import DataLoader
 from tqdm import tqdm
@@ -15,11 +13,15 @@ from modules.config.configuration import Configuration
 from modules.dataset import ImpressionDataset
 from modules.trainer import NCTrainer
 from modules.utils import (
-    gather_dict,
+    gather_array,
     load_batch_data,
-    get_news_embeds,
+    get_news_cache,
     gpu_stat,
     group_auc,
+    batched_metrics,
+    concat_padded,
+    copy_to_host,
+    CUDAPrefetcher,
 )
 
 
@@ -38,7 +40,40 @@ class MindRSTrainer(NCTrainer):
         self.topic_variant = config.get("topic_variant", "base")
         self.train_strategy = config.get("train_strategy", "pair_wise")
         self.mind_loader = data_loader
-        self.behaviors = data_loader.valid_set.behaviors
+        self.valid_set = data_loader.valid_set
+        self.behaviors = self.valid_set.behaviors
+        # model without the distributed wrapper, resolved once instead of at every validation
+        self.is_distributed = torch.distributed.is_initialized()
+        self.unwrapped_model = self.accelerator.unwrap_model(self.model)
+        # compile model to fuse kernels (torch>=2.0), validation keeps using the eager model for varying shapes
+        self.train_model, self.news_encoder = self.model, None
+        if config.get("compile_model", False):
+            self.train_model = torch.compile(
+                self.model, mode=config.get("compile_mode", "reduce-overhead"), dynamic=False
+            )
+            # news encoder used for caching news embeddings runs on batches of all news
+            self.news_encoder = torch.compile(
+                self.unwrapped_model.news_encoder,
+                mode="max-autotune",
+                dynamic=False,
+            )
+        # faster kernels at the cost of reproducibility, set_seed turns cudnn benchmark off by default
+        if config.get("allow_tf32", False):
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+        if config.get("cudnn_benchmark", False):
+            torch.backends.cudnn.benchmark = True
+            torch.backends.cudnn.deterministic = False
+        # optional numba kernels for ranking metrics, default is the vectorized numpy version
+        self.batched_metric_funcs = None
+        if config.get("metric_backend", "numpy") == "numba":
+            try:
+                from modules.utils.numba_metric_utils import NUMBA_BATCHED_METRICS, warmup_numba_metrics
+
+                warmup_numba_metrics()  # compile kernels before the first validation
+                self.batched_metric_funcs = NUMBA_BATCHED_METRICS
+            except ImportError:
+                self.logger.warning("numba is not installed, fall back to numpy metrics")
 
     def _validation(self, epoch, batch_idx, do_monitor=True):
         # do validation when reach the interval
@@ -68,28 +103,28 @@ class MindRSTrainer(NCTrainer):
             enumerate(self.train_loader),
             total=self.len_epoch,
             disable=self.config.get("disable_tqdm", True),
+            mininterval=1.0,
+            miniters=self.log_step,
         )
+        # detached scalars stay on device and are synchronized to host only at log steps
+        running_metrics, staged_auc = defaultdict(list), []
         # self._validation(epoch, 0)
         for batch_idx, batch_dict in bar:
             # set step for tensorboard
             self.step = (epoch - 1) * self.len_epoch + batch_idx
             self.writer.set_step(self.step)
-            label = copy.deepcopy(batch_dict["label"].cpu().numpy())
             # load data to device
             batch_dict = load_batch_data(batch_dict, self.device)
             # setup model and train model
             self.optimizer.zero_grad()
-            output = self.model(batch_dict)
+            output = self.train_model(batch_dict)
             loss = self.criterion(output["pred"], batch_dict["label"])
-            self.train_metrics.update(
-                "auc", group_auc(label, output["pred"].cpu().detach().numpy())
-            )
-            # gpu_used = torch.cuda.memory_allocated() / 1024 ** 3
-            bar_description = f"Epoch: {epoch} {gpu_stat()}"
+            # clone model outputs, which may be overwritten by the next replay of a compiled (cuda graph) model
+            staged_auc.append((batch_dict["label"], output["pred"].detach().clone()))
             if self.add_l2norm:
                 l2_norm = sum(p.pow(2.0).sum() for p in self.model.parameters())
                 loss += self.l2_lambda * l2_norm
-                self.train_metrics.update("l2_norm", l2_norm.item())
+                running_metrics["l2_norm"].append(l2_norm.detach())
             if self.with_entropy or self.show_entropy:
                 if self.entropy_mode == "static":
                     entropy_loss = self.alpha * output["entropy"]
@@ -99,21 +134,26 @@ class MindRSTrainer(NCTrainer):
                         self.alpha * (1 / (10**magnitude)) * output["entropy"]
                     )
                 loss += entropy_loss
-                bar_description += f" Entropy(Scaled): {round(entropy_loss.item(), 4)}"
-                bar_description += (
-                    f" Entropy(Origin): {round(output['entropy'].item(), 4)}"
-                )
-                self.train_metrics.update("entropy_origin", output["entropy"].item())
-                self.train_metrics.update("entropy_loss", entropy_loss.item())
+                running_metrics["entropy_origin"].append(output["entropy"].detach().clone())
+                running_metrics["entropy_loss"].append(entropy_loss.detach())
             if self.topic_variant == "variational_topic":
                 loss += self.beta * output["kl_divergence"]
-                bar_description += f" KL divergence: {output['kl_divergence'].item()}"
-            bar_description += f" Loss: {round(loss.item(), 4)}"
             self.accelerator.backward(loss)
             self.optimizer.step()
             # record loss
-            self.train_metrics.update("loss", loss.item())
+            running_metrics["loss"].append(loss.detach())
             if batch_idx % self.log_step == 0:
+                self._flush_train_metrics(running_metrics, staged_auc)
+                # gpu_used = torch.cuda.memory_allocated() / 1024 ** 3
+                bar_description = f"Epoch: {epoch} {gpu_stat()}"
+                if self.with_entropy or self.show_entropy:
+                    bar_description += f" Entropy(Scaled): {round(entropy_loss.item(), 4)}"
+                    bar_description += (
+                        f" Entropy(Origin): {round(output['entropy'].item(), 4)}"
+                    )
+                if self.topic_variant == "variational_topic":
+                    bar_description += f" KL divergence: {output['kl_divergence'].item()}"
+                bar_description += f" Loss: {round(loss.item(), 4)}"
                 if self.log_kl_div:
                     self.model.eval()
                     middle_name = f"train_{epoch}_{batch_idx}"
@@ -133,12 +173,30 @@ class MindRSTrainer(NCTrainer):
                 self.train_metrics.reset()
             if (batch_idx + 1) % math.ceil(self.len_epoch * self.valid_interval) == 0:
                 self._validation(epoch, batch_idx)
+        self._flush_train_metrics(running_metrics, staged_auc)
         if self.lr_scheduler is not None:
             self.lr_scheduler.step()
         log = self.train_metrics.result()
         log.update(self._validation(epoch, self.len_epoch, False))
         return log
 
+    def _flush_train_metrics(self, running_metrics, staged_auc):
+        """synchronize metrics accumulated on device since the last log step and update the tracker"""
+        for key, values in running_metrics.items():
+            self.train_metrics.update(key, torch.stack(values).float().mean().item(), n=len(values))
+        if staged_auc:
+            # concatenate staged batches on device and copy them to host with one transfer each
+            labels = concat_padded([label for label, _ in staged_auc]).cpu().numpy()
+            preds = concat_padded([pred for _, pred in staged_auc]).cpu().numpy()
+            auc, start = [], 0
+            for label, _ in staged_auc:
+                end, width = start + label.shape[0], label.shape[1]
+                auc.append(group_auc(labels[start:end, :width], preds[start:end, :width]))
+                start = end
+            self.train_metrics.update("auc", np.mean(auc), n=len(auc))
+        running_metrics.clear()
+        staged_auc.clear()
+
     def _valid_epoch(self, model=None, valid_set=None, middle_name=None):
         """
         Validate after training an epoch
@@ -146,107 +204,108 @@ class MindRSTrainer(NCTrainer):
         :param valid_set: valid_set
         :return: A log that contains information about validation
         """
-        result_dict = {}
+        results = defaultdict(list)  # chunks of impression indices and metric scores
         impression_bs = self.config.get("impression_batch_size", 128)
         valid_method = self.config.get("valid_method", "fast_evaluation")
-        if torch.distributed.is_initialized():
-            model = self.model.module if model is None else model.module
-        else:
-            model = self.model if model is None else model
-        valid_set = self.mind_loader.valid_set if valid_set is None else valid_set
+        if model is None:
+            model = self.unwrapped_model
+        elif self.is_distributed:
+            model = model.module
+        valid_set = self.valid_set if valid_set is None else valid_set
         model.eval()
-        weight_dict = defaultdict(lambda: [])
+        weight_dict = defaultdict(list)  # chunks of saved weights
         topic_variant = self.config.get("topic_variant", "base")
         return_weight = self.config.get("return_weight", False)
 
         saved_weight_num = self.config.get("saved_weight_num", 250)
-        with torch.no_grad():
+        with torch.inference_mode():
             try:  # try to do fast evaluation: cache news embeddings
                 if (
                     valid_method == "fast_evaluation"
-                    and not return_weight
-                    and not self.with_entropy
                     and not topic_variant == "variational_topic"
                 ):
-                    news_loader = self.mind_loader.news_loader
-                    news_embeds = get_news_embeds(
+                    # run news encoder once over all news, weights are cached as well if required
+                    cache_keys = ["news_embed"]
+                    if return_weight:
+                        cache_keys.extend(["news_weight", "topic_weight"])
+                    # cache is kept in half precision by default to halve its memory traffic
+                    cache_dtype = getattr(
+                        torch, self.config.get("news_cache_dtype", "float16")
+                    )
+                    news_cache = get_news_cache(
                         model,
-                        news_loader,
+                        self.mind_loader.news_loader,
+                        cache_keys=cache_keys,
+                        news_encoder=self.news_encoder
+                        if model is self.unwrapped_model
+                        else None,
                         device=self.device,
                         accelerator=self.accelerator,
                         num_processes=self.config.get("num_processes", None),
+                        dtype=cache_dtype,
+                        return_tensors=True,
                     )
+                    news_cache = {
+                        k: v.to(self.device) for k, v in news_cache.items()
+                    }
                 else:
-                    news_embeds = None
-            except KeyError or RuntimeError:  # slow evaluation: re-calculate news embeddings every time
-                news_embeds = None
+                    news_cache = None
+            except (KeyError, RuntimeError) as e:  # slow evaluation: re-calculate news embeddings every time
+                self.logger.warning(f"Fast evaluation is skipped and falls back to slow evaluation: {e!r}")
+                news_cache = None
             imp_set = ImpressionDataset(
                 valid_set,
-                news_embeds,
                 selected_imp=self.config.get("selected_imp", None),
             )
             valid_loader = DataLoader(
-                imp_set, impression_bs, collate_fn=self.mind_loader.fn
+                imp_set,
+                impression_bs,
+                collate_fn=self.mind_loader.fn,
+                pin_memory=True,
+                num_workers=self.config.get("num_workers", 0),
             )
-            valid_loader = self.accelerator.prepare_data_loader(valid_loader)
+            if self.accelerator.num_processes > 1:
+                valid_loader = self.accelerator.prepare_data_loader(valid_loader)
+            else:  # overlap copies of the next batch with running the current batch
+                valid_loader = CUDAPrefetcher(valid_loader, self.device)
             bar = tqdm(
                 enumerate(valid_loader),
                 total=len(valid_loader),
                 disable=self.config.get("disable_tqdm", True),
             )
+            # outputs are staged on device and copied to host every transfer_interval batches
+            transfer_interval = self.config.get("valid_transfer_interval", 50)
+            staged_outputs, pending = [], None
             for vi, batch_dict in bar:
                 batch_dict = load_batch_data(batch_dict, self.device)
-                label = batch_dict["label"].cpu().numpy()
+                if news_cache is not None:  # gather news vectors from the cache
+                    batch_dict["news_cache"] = news_cache
                 out_dict = model(batch_dict)  # run model
-                pred = out_dict["pred"].cpu().numpy()
-                can_len = batch_dict["candidate_length"].cpu().numpy()
-                his_len = batch_dict["history_length"].cpu().numpy()
-                for i in range(len(label)):
-                    bar.set_description(f"Validating: {gpu_stat()}")
-                    index = (
-                        batch_dict["impression_index"][i].cpu().tolist()
-                    )  # record impression index
-                    result_dict[index] = {
-                        m.__name__: m(label[i][: can_len[i]], pred[i][: can_len[i]])
-                        * 100
-                        for m in self.metric_funcs
-                    }  # convert to percentage
-                    if return_weight:
-                        saved_items = {
-                            "impression_index": index,
-                            "results": result_dict[index],
-                            "label": label[i][: can_len[i]],
-                            "candidate_index": batch_dict["candidate_index"][i][
-                                : can_len[i]
-                            ]
-                            .cpu()
-                            .tolist(),
-                            "history_index": batch_dict["history_index"][i][
-                                : his_len[i]
-                            ]
-                            .cpu()
-                            .numpy(),
-                            "pred_score": pred[i][: can_len[i]],
-                        }
-                        for name, indices in saved_items.items():
-                            weight_dict[name].append(indices)
-                        for name, weight in out_dict.items():
-                            if "weight" in name:
-                                if "candidate" in name:
-                                    length = can_len[i]
-                                else:
-                                    length = his_len[i]
-                                weight_dict[name].append(
-                                    weight[i][:length].cpu().numpy()
-                                )
+                staged_outputs.append(
+                    self._stage_outputs(batch_dict, out_dict, return_weight)
+                )
+                bar.set_description(f"Validating: {gpu_stat()}")
+                if len(staged_outputs) >= transfer_interval:
+                    # copy current outputs without blocking and process the previous copy meanwhile
+                    previous, pending = pending, self._transfer_outputs(staged_outputs)
+                    self._collect_results(previous, results, weight_dict)
+                    staged_outputs = []
                 if vi >= saved_weight_num and return_weight:
                     break
-            result_dict = gather_dict(
-                result_dict, num_processes=self.config.get("num_processes", None)
-            )
-            eval_result = dict(
-                np.round(pd.DataFrame.from_dict(result_dict, orient="index").mean(), 4)
-            )  # average
+            self._collect_results(pending, results, weight_dict)
+            if len(staged_outputs):
+                pending = self._transfer_outputs(staged_outputs)
+                self._collect_results(pending, results, weight_dict)
+            num_processes = self.config.get("num_processes", None)
+            results = {
+                k: gather_array(np.concatenate(v), num_processes)
+                for k, v in results.items()
+            }
+            # impressions repeated in padded batches or across processes are counted once
+            _, unique = np.unique(results.pop("impression_index"), return_index=True)
+            eval_result = {
+                k: np.round(np.nanmean(v[unique]), 4) for k, v in results.items()
+            }  # average
             if self.config.get("evaluate_topic_by_epoch", False) and self.config.get(
                 "topic_evaluation_method", None
             ):
@@ -255,23 +314,93 @@ class MindRSTrainer(NCTrainer):
         if return_weight and self.accelerator.is_main_process:
             weight_dir = Path(self.config["model_dir"], "weight")
             os.makedirs(weight_dir, exist_ok=True)
-            weight_path = weight_dir / f"{self.config.get('head_num')}.pt"
+            weight_path = weight_dir / f"{self.config.get('head_num')}.npz"
+            weights = {k: np.concatenate(v) for k, v in weight_dict.items()}
             if weight_path.exists():
-                old_weights = torch.load(weight_path)
-                for key in weight_dict.keys():
-                    weight_dict[key].extend(old_weights[key])
-            torch.save(dict(weight_dict), weight_path)
+                with np.load(weight_path) as old_weights:  # close the file before overwriting it
+                    weights = {
+                        k: np.concatenate([v, old_weights[k]]) for k, v in weights.items()
+                    }
+            np.savez_compressed(weight_path, **weights)
             self.logger.info(f"Saved weight to {weight_path}")
         del batch_dict
         torch.cuda.empty_cache()
         return eval_result
 
+    @staticmethod
+    def _stage_outputs(batch_dict, out_dict, return_weight=False):
+        """select tensors (still on device) of a validation batch that are used to compute results"""
+        outputs = {
+            "label": batch_dict["label"],
+            "pred": out_dict["pred"],
+            "candidate_length": batch_dict["candidate_length"],
+            "history_length": batch_dict["history_length"],
+            "impression_index": batch_dict["impression_index"],
+        }
+        if return_weight:
+            outputs["candidate_index"] = batch_dict["candidate_index"]
+            outputs["history_index"] = batch_dict["history_index"]
+            outputs.update({k: v for k, v in out_dict.items() if "weight" in k})
+        return outputs
+
+    @staticmethod
+    def _transfer_outputs(staged_outputs):
+        """concatenate staged outputs of several batches and copy them to host with one transfer per key"""
+        outputs = {
+            k: concat_padded([o[k] for o in staged_outputs])
+            for k in staged_outputs[0].keys()
+        }
+        return copy_to_host(outputs)
+
+    def _collect_results(self, pending, results, weight_dict):
+        """compute metrics (and save weights) of the transferred outputs"""
+        if pending is None:
+            return
+        outputs, event = pending
+        if event is not None:
+            event.synchronize()  # wait until the copy finished
+        outputs = {k: v.numpy() for k, v in outputs.items()}
+        label, pred = outputs["label"], outputs["pred"]
+        can_len, his_len = outputs["candidate_length"], outputs["history_length"]
+        # compute metrics of the whole batch over padded matrices
+        can_mask = np.arange(label.shape[1]) < can_len[:, None]
+        batch_results = batched_metrics(
+            label, pred, can_mask, self.metric_funcs, self.batched_metric_funcs
+        )
+        results["impression_index"].append(outputs["impression_index"])
+        for name, scores in batch_results.items():
+            results[name].append(scores * 100)  # convert to percentage
+        if "candidate_index" not in outputs:
+            return
+        # keep valid entries of all impressions (flattened in order), weights are saved in half precision
+        weight_dict["impression_index"].append(outputs["impression_index"])
+        weight_dict["candidate_length"].append(can_len)
+        weight_dict["history_length"].append(his_len)
+        for name, scores in batch_results.items():
+            weight_dict[f"results_{name}"].append(scores * 100)
+        ragged_items = {
+            "label": label,
+            "pred_score": pred,
+            "candidate_index": outputs["candidate_index"],
+            "history_index": outputs["history_index"],
+        }
+        ragged_items.update(
+            {k: v.astype(np.float16) for k, v in outputs.items() if "weight" in k}
+        )
+        for name, values in ragged_items.items():
+            if name in ["label", "pred_score"] or "candidate" in name:
+                length = can_len
+            else:
+                length = his_len
+            weight_dict[name].append(
+                values[np.arange(values.shape[1]) < length[:, None]]
+            )
+
     def evaluate(self, dataset, model, epoch=0, prefix="val"):
         """call this method after training"""
         model.eval()
         log = self._valid_epoch(model, dataset)
-        # for (name, p,) in (model.named_parameters()):  # add histogram of model parameters to the tensorboard
-        #     self.writer.add_histogram(name, p, bins="auto")
+        self.log_param_histograms(model)  # add histogram of model parameters to the tensorboard
         if prefix:
             log = {f"{prefix}_{k}": v for k, v in log.items()}
         return log  # return log with prefix
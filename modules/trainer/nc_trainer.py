@@ -1,6 +1,7 @@
 import copy
 import torch
 import torch.distributed
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 from modules.base.base_trainer import BaseTrainer
@@ -30,6 +31,7 @@ class NCTrainer(BaseTrainer):
         self.train_metrics = MetricTracker(*self.metric_funcs, writer=self.writer)
         self.valid_metrics = MetricTracker(*self.metric_funcs, writer=self.writer)
         self.topic_evaluator = TopicEval(config, word_dict=data_loader.word_dict, group_name="topic_eval")
+        self.histogram_executor = ThreadPoolExecutor(max_workers=1)  # log parameter histograms in background
         self.model, self.optimizer, self.train_loader, self.lr_scheduler = self.accelerator.prepare(
             self.model, self.optimizer, self.train_loader, self.lr_scheduler)
 
@@ -95,7 +97,7 @@ class NCTrainer(BaseTrainer):
         model.eval()
         self.valid_metrics.reset()
         labels, predicts = [], []
-        with torch.no_grad():
+        with torch.inference_mode():
             for batch_idx, batch_dict in tqdm(enumerate(loader), total=len(loader)):
                 out_dict = self.run_model(batch_dict, model, multi_gpu=False)
                 self.writer.set_step((epoch - 1) * len(loader) + batch_idx, "evaluate")
@@ -103,11 +105,24 @@ class NCTrainer(BaseTrainer):
                 labels.extend(out_dict["label"].cpu().tolist())
                 predicts.extend(torch.argmax(out_dict["predict"], dim=1).cpu().tolist())
         self.update_metrics(self.valid_metrics, predicts=predicts, labels=labels)
-        for name, p in model.named_parameters():  # add histogram of model parameters to the tensorboard
-            self.writer.add_histogram(name, p, bins='auto')
+        self.log_param_histograms(model)  # add histogram of model parameters to the tensorboard
         log = {f"{prefix}_{k}": v for k, v in self.valid_metrics.result().items()}  # return log with prefix
         return log
 
+    def log_param_histograms(self, model):
+        """
+        add histograms of model parameters to the tensorboard if log_param_histograms is set,
+        parameters are copied to cpu in one pass and histograms are computed in a background thread
+        """
+        if not self.config.get("log_param_histograms", False) or self.writer.writer is None:
+            return
+        params = {name: p.detach().cpu() for name, p in model.named_parameters()}
+        self.histogram_executor.submit(self._add_histograms, params, self.writer.step)
+
+    def _add_histograms(self, params, step):
+        for name, p in params.items():
+            self.writer.writer.add_histogram(name, p.numpy(), step, bins="auto")
+
     def topic_evaluation(self, model=None, middle_name=None):
         """
         evaluate the topic quality of the BATM model using the topic coherence
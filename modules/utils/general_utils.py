@@ -7,6 +7,7 @@ import pynvml
 import torch
 import wandb
 import torch.distributed
+import torch.nn.functional as F
 import numpy as np
 from collections import OrderedDict
 from pathlib import Path
@@ -126,27 +127,67 @@ def init_model_class(config, *args, **kwargs):
     return model_class
 
 
-def gather_dict(dict_object, num_processes=None):
+def _all_gather_padded(tensor, num_processes=None):
     """
-    gather vectors from all processes
+    gather tensors with different lengths (first dimension) from all processes with all_gather_into_tensor
+    :param tensor: tensor to gather, other dimensions should be the same across processes
     :param num_processes: number of process
-    :param dict_object: vectors to gather
-    :return: gathered numpy array vectors
+    :return: list of gathered tensors, one for each process
+    """
+    if torch.distributed.get_backend() == "nccl":  # nccl only supports cuda tensors
+        device = torch.device("cuda", torch.cuda.current_device())
+    else:
+        device = torch.device("cpu")
+    num_processes = torch.distributed.get_world_size() if num_processes is None else num_processes
+    tensor = tensor.to(device)
+    lengths = torch.empty(num_processes, dtype=torch.long, device=device)
+    torch.distributed.all_gather_into_tensor(lengths, torch.tensor([len(tensor)], device=device))
+    lengths = lengths.tolist()
+    # pad to the same length so that all processes pass the same shape
+    padded = tensor.new_zeros((max(lengths),) + tensor.shape[1:])
+    padded[: len(tensor)] = tensor
+    output = tensor.new_empty((num_processes * max(lengths),) + tensor.shape[1:])
+    torch.distributed.all_gather_into_tensor(output, padded)
+    output = output.view((num_processes, max(lengths)) + tensor.shape[1:])
+    return [output[i, :n] for i, n in enumerate(lengths)]
+
+
+def gather_array(array, num_processes=None):
+    """
+    gather numpy arrays from all processes and concatenate them (unchanged if not distributed)
+    :param array: numpy array to gather, shapes except the first dimension should be the same across processes
+    :param num_processes: number of process
+    :return: concatenated numpy array
     """
     if torch.distributed.is_initialized():
-        num_processes = (
-            torch.distributed.get_world_size()
-            if num_processes is None
-            else num_processes
-        )
-        dicts_object = [
-            {} for _ in range(num_processes)
-        ]  # used for distributed inference
-        torch.distributed.barrier()
-        torch.distributed.all_gather_object(dicts_object, dict_object)
-        for i in range(num_processes):
-            dict_object.update(dicts_object[i])
-    return dict_object
+        arrays = _all_gather_padded(torch.from_numpy(np.ascontiguousarray(array)), num_processes)
+        array = torch.cat(arrays).cpu().numpy()
+    return array
+
+
+def gather_tensors(tensors, num_processes=None):
+    """
+    gather tensors from all processes with a single payload collective, rows of all tensors are viewed as bytes
+    and packed into one buffer, so tensors with different dtypes and shapes are transferred together
+    :param tensors: list of tensors with the same first dimension
+    :param num_processes: number of process
+    :return: list of gathered tensors concatenated over processes (unchanged if not distributed)
+    """
+    if not torch.distributed.is_initialized():
+        return tensors
+    length = len(tensors[0])
+    row_sizes = [int(np.prod(t.shape[1:])) * t.element_size() for t in tensors]
+    rows = torch.cat(
+        [t.reshape(length, -1 if length else int(np.prod(t.shape[1:]))).contiguous().view(torch.uint8)
+         for t in tensors], dim=1
+    )
+    rows = torch.cat(_all_gather_padded(rows, num_processes))
+    gathered, offset = [], 0
+    for t, size in zip(tensors, row_sizes):
+        values = rows[:, offset:offset + size].contiguous().view(t.dtype)
+        gathered.append(values.view((len(rows),) + t.shape[1:]))
+        offset += size
+    return gathered
 
 
 def convert_dict_to_numpy(dict_object):
@@ -164,7 +205,79 @@ def load_batch_data(batch_dict, device, multi_gpu=True):
     """
     if torch.distributed.is_initialized() and multi_gpu:  # use multi-gpu
         return batch_dict
-    return {k: v.to(device) for k, v in batch_dict.items()}
+    return {k: v.to(device, non_blocking=True) for k, v in batch_dict.items()}
+
+
+class CUDAPrefetcher:
+    """
+    Iterate over a data loader and copy the next batch to device on a side cuda stream,
+    so that host-to-device copies overlap with the computation of the current batch
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch_dict):
+        if batch_dict is None:
+            return None
+        if self.stream is None:
+            return load_batch_data(batch_dict, self.device, multi_gpu=False)
+        with torch.cuda.stream(self.stream):
+            return {k: v.to(self.device, non_blocking=True) for k, v in batch_dict.items()}
+
+    def __iter__(self):
+        loader = iter(self.loader)
+        next_batch = self._to_device(next(loader, None))
+        while next_batch is not None:
+            batch_dict = next_batch
+            if self.stream is not None:  # wait for the copy and keep tensors alive for the compute stream
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                for v in batch_dict.values():
+                    v.record_stream(current_stream)
+            next_batch = self._to_device(next(loader, None))  # copy next batch while computing this one
+            yield batch_dict
+
+
+def concat_padded(tensors, pad_value=0):
+    """
+    concatenate tensors along the first dimension, other dimensions are padded to the largest size
+    :param tensors: list of tensors with the same number of dimensions
+    :param pad_value: value of padded entries
+    :return: concatenated tensor
+    """
+    max_shape = [max(t.size(d) for t in tensors) for d in range(tensors[0].dim())]
+    padded = []
+    for t in tensors:
+        pad = []
+        for d in reversed(range(1, t.dim())):  # F.pad starts from the last dimension
+            pad.extend([0, max_shape[d] - t.size(d)])
+        padded.append(F.pad(t, pad, value=pad_value) if any(pad) else t)
+    return torch.cat(padded)
+
+
+def copy_to_host(tensor_dict):
+    """
+    copy tensors to (pinned) host memory without blocking, call event.synchronize() before reading them
+    :param tensor_dict: dictionary of tensors on device
+    :return: dictionary of host tensors and the event recorded after copying (None if no cuda tensors)
+    """
+    host_dict, event = {}, None
+    for k, v in tensor_dict.items():
+        if v.is_cuda:
+            host_dict[k] = torch.empty(v.shape, dtype=v.dtype, pin_memory=True)
+            host_dict[k].copy_(v, non_blocking=True)
+        else:
+            host_dict[k] = v
+    if any(v.is_cuda for v in tensor_dict.values()):
+        event = torch.cuda.Event()
+        event.record()
+    return host_dict, event
 
 
 def gpu_stat():
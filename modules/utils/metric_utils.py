@@ -1,5 +1,6 @@
 import pandas as pd
 import numpy as np
+from functools import partial
 from sklearn.metrics import f1_score
 from scipy.special import kl_div
 from .auc_utils import roc_auc_score
@@ -140,6 +141,98 @@ def ndcg_10(label, pred):
     return ndcg(label, pred, 10)
 
 
+def _rank_labels(label, pred, mask):
+    """
+    Reorder labels of each row by descending predicted scores, padded entries are moved to the end
+    :param label: np.ndarray with shape (B, L), padded labels
+    :param pred: np.ndarray with shape (B, L), padded predicted scores
+    :param mask: boolean np.ndarray with shape (B, L), True for valid entries
+    :return: ranked labels with shape (B, L)
+    """
+    # reversed stable sort, tied scores are ranked by descending position (numba kernels use the same order)
+    order = np.argsort(np.where(mask, pred, -np.inf), axis=1, kind="stable")[:, ::-1]
+    return np.take_along_axis(np.where(mask, label, 0), order, axis=1)
+
+
+def _batched_auc(label, pred, mask):
+    """
+    Compute AUC of each row with the rank statistic, tied scores get average ranks as in sklearn's roc_auc_score;
+    group_auc (auc_utils.roc_auc_score) handles ties differently, so the two only agree on rows without tied scores
+    :return: AUC scores with shape (B,)
+    """
+    rows, cols = np.nonzero(mask)
+    scores, labels = pred[rows, cols], label[rows, cols]
+    order = np.lexsort((scores, rows))  # sort by row first and then by score
+    rows, scores, labels = rows[order], scores[order], labels[order]
+    positions = np.arange(len(rows))
+    row_start = np.searchsorted(rows, np.arange(len(mask)))
+    ranks = positions - row_start[rows] + 1  # rank within each row
+    # entries with the same score in the same row share their average rank
+    new_group = np.r_[True, (rows[1:] != rows[:-1]) | (scores[1:] != scores[:-1])]
+    group = np.cumsum(new_group) - 1
+    group_ranks = np.bincount(group, weights=ranks) / np.bincount(group)
+    pos_rank_sum = np.bincount(rows, weights=group_ranks[group] * labels, minlength=len(mask))
+    pos_num = np.bincount(rows, weights=labels, minlength=len(mask))
+    neg_num = mask.sum(axis=1) - pos_num
+    return (pos_rank_sum - pos_num * (pos_num + 1) / 2) / (pos_num * neg_num)
+
+
+def _batched_mrr(label, pred, mask):
+    """
+    Compute MRR of each row
+    :return: MRR scores with shape (B,)
+    """
+    ranked = _rank_labels(label, pred, mask)
+    rr_score = ranked / (np.arange(ranked.shape[1]) + 1)
+    return np.sum(rr_score, axis=1) / np.sum(ranked, axis=1)
+
+
+def _batched_dcg(ranked, k):
+    ranked = ranked[:, :k]
+    discounts = np.log2(np.arange(ranked.shape[1]) + 2)
+    return np.sum((2 ** ranked - 1) / discounts, axis=1)
+
+
+def _batched_ndcg(label, pred, mask, k=10):
+    """
+    Compute NDCG@k of each row
+    :return: NDCG scores with shape (B,)
+    """
+    best = _batched_dcg(_rank_labels(label, label, mask), k)
+    actual = _batched_dcg(_rank_labels(label, pred, mask), k)
+    return actual / best
+
+
+BATCHED_METRICS = {
+    "group_auc": _batched_auc,
+    "mean_mrr": _batched_mrr,
+    "ndcg_5": partial(_batched_ndcg, k=5),
+    "ndcg_10": partial(_batched_ndcg, k=10),
+}
+
+
+def batched_metrics(label, pred, mask, metric_funcs, batched_funcs=None):
+    """
+    Compute metrics of each impression over padded matrices
+    :param label: np.ndarray with shape (B, L), padded labels of impressions
+    :param pred: np.ndarray with shape (B, L), padded predicted scores of impressions
+    :param mask: boolean np.ndarray with shape (B, L), True for valid candidates
+    :param metric_funcs: metric functions, metrics without a batched version are computed row by row
+    :param batched_funcs: dictionary of metric name and batched implementation, default is BATCHED_METRICS
+    :return: dictionary of metric name and scores with shape (B,)
+    """
+    batched_funcs = BATCHED_METRICS if batched_funcs is None else batched_funcs
+    results = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for m in metric_funcs:
+            if m.__name__ in batched_funcs:
+                results[m.__name__] = batched_funcs[m.__name__](label, pred, mask)
+            else:
+                lengths = mask.sum(axis=1)
+                results[m.__name__] = np.array([m(l[:n], p[:n]) for l, p, n in zip(label, pred, lengths)])
+    return results
+
+
 def kl_divergence_rowwise(matrix):
     n_rows = matrix.shape[0]
     kl_divergences = []
@@ -0,0 +1,124 @@
+import numpy as np
+from functools import partial
+from numba import njit, prange
+
+# fast-math without "nnan": impressions with a single class are reported as nan
+FASTMATH = {"contract", "arcp", "reassoc", "nsz", "afn"}
+
+
+@njit(fastmath=FASTMATH, cache=True)
+def _row_auc(label, pred):
+    n = len(pred)
+    order = np.argsort(pred)
+    ranks = np.empty(n)
+    i = 0
+    while i < n:  # entries with the same score share their average rank
+        j = i
+        while j + 1 < n and pred[order[j + 1]] == pred[order[i]]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[order[k]] = (i + j) / 2 + 1
+        i = j + 1
+    pos_num, pos_rank_sum = 0.0, 0.0
+    for k in range(n):
+        if label[k] > 0:
+            pos_num += 1
+            pos_rank_sum += ranks[k]
+    neg_num = n - pos_num
+    if pos_num == 0 or neg_num == 0:
+        return np.nan
+    return (pos_rank_sum - pos_num * (pos_num + 1) / 2) / (pos_num * neg_num)
+
+
+@njit(fastmath=FASTMATH, cache=True)
+def _descending_order(values):
+    # reversed stable sort, the same tie order as _rank_labels of metric_utils
+    return np.argsort(values, kind="mergesort")[::-1]
+
+
+@njit(fastmath=FASTMATH, cache=True)
+def _row_mrr(label, pred):
+    order = _descending_order(pred)
+    rr_score, label_sum = 0.0, 0.0
+    for r in range(len(order)):
+        rr_score += label[order[r]] / (r + 1)
+        label_sum += label[r]
+    if label_sum == 0:
+        return np.nan
+    return rr_score / label_sum
+
+
+@njit(fastmath=FASTMATH, cache=True)
+def _row_dcg(label, order, k):
+    dcg = 0.0
+    for r in range(min(k, len(order))):
+        dcg += (2 ** label[order[r]] - 1) / np.log2(r + 2)
+    return dcg
+
+
+@njit(fastmath=FASTMATH, cache=True)
+def _row_ndcg(label, pred, k):
+    best = _row_dcg(label, _descending_order(label), k)
+    if best == 0:
+        return np.nan
+    return _row_dcg(label, _descending_order(pred), k) / best
+
+
+@njit(parallel=True, fastmath=FASTMATH, cache=True)
+def _flat_auc(label, pred, offsets, out):
+    for b in prange(len(offsets) - 1):
+        s, e = offsets[b], offsets[b + 1]
+        out[b] = _row_auc(label[s:e], pred[s:e])
+
+
+@njit(parallel=True, fastmath=FASTMATH, cache=True)
+def _flat_mrr(label, pred, offsets, out):
+    for b in prange(len(offsets) - 1):
+        s, e = offsets[b], offsets[b + 1]
+        out[b] = _row_mrr(label[s:e], pred[s:e])
+
+
+@njit(parallel=True, fastmath=FASTMATH, cache=True)
+def _flat_ndcg(label, pred, offsets, out, k):
+    for b in prange(len(offsets) - 1):
+        s, e = offsets[b], offsets[b + 1]
+        out[b] = _row_ndcg(label[s:e], pred[s:e], k)
+
+
+def _numba_metric(label, pred, mask, kernel, k=None):
+    """
+    Flatten padded matrices into ragged arrays with row offsets and run the jit kernel over all impressions
+    :param label: np.ndarray with shape (B, L), padded labels
+    :param pred: np.ndarray with shape (B, L), padded predicted scores
+    :param mask: boolean np.ndarray with shape (B, L), True for valid entries
+    :param kernel: jit kernel with signature (label, pred, offsets, out) or (label, pred, offsets, out, k)
+    :param k: cutoff passed to the kernel if given
+    :return: scores with shape (B,)
+    """
+    offsets = np.zeros(len(mask) + 1, dtype=np.int64)
+    np.cumsum(mask.sum(axis=1), out=offsets[1:])
+    # kernels are compiled for float64 inputs only, which also covers half precision predictions
+    label_flat, pred_flat = label[mask].astype(np.float64), pred[mask].astype(np.float64)
+    out = np.empty(len(mask))
+    if k is None:
+        kernel(label_flat, pred_flat, offsets, out)
+    else:
+        kernel(label_flat, pred_flat, offsets, out, k)
+    return out
+
+
+NUMBA_BATCHED_METRICS = {
+    "group_auc": partial(_numba_metric, kernel=_flat_auc),
+    "mean_mrr": partial(_numba_metric, kernel=_flat_mrr),
+    "ndcg_5": partial(_numba_metric, kernel=_flat_ndcg, k=5),
+    "ndcg_10": partial(_numba_metric, kernel=_flat_ndcg, k=10),
+}
+
+
+def warmup_numba_metrics():
+    """
+    Compile the jit kernels once with a dummy impression, so the first validation batch does not pay for it
+    """
+    label, pred, mask = np.array([[1, 0, 0]]), np.array([[0.3, 0.2, 0.1]]), np.ones((1, 3), dtype=bool)
+    for func in NUMBA_BATCHED_METRICS.values():
+        func(label, pred, mask)
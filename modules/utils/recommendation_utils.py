@@ -1,34 +1,89 @@
 import os
+import numpy as np
+import torch
 
 from tqdm import tqdm
 from pathlib import Path
-from modules.utils import convert_dict_to_numpy, gather_dict, load_batch_data, gpu_stat, get_project_root
+from modules.utils import gather_tensors, load_batch_data, gpu_stat, get_project_root
 
 
-def get_news_embeds(model, news_loader, **kwargs):
+def get_news_cache(model, news_loader, **kwargs):
     """
-    run news model and return news vectors (numpy matrix)
+    run news encoder once over all news and cache its outputs (one matrix for each output), news are sharded across
+    processes and outputs of all processes are gathered with one collective
     :param model: target running model
     :param news_loader: news loader with all news data
-    :return: numpy matrix of news vectors (each row is a news vector)
+    :param cache_keys: outputs of news encoder to cache, default only caches news vectors
+    :param news_encoder: callable used to encode news (e.g. a compiled one), default is model.news_encoder
+    :param dtype: torch dtype of cached outputs, they are cast before gathering, default keeps the output dtype
+    :param return_tensors: return torch tensors on the running device instead of numpy matrices
+    :return: dictionary of matrices (row i is the output of news with index i)
     """
-    news_embeds = {}
+    cache_keys = kwargs.get("cache_keys", ["news_embed"])
+    news_indices, news_cache = [], {key: [] for key in cache_keys}
     assert news_loader is not None, "must specify news_loader"
     accelerator = kwargs.get("accelerator", None)
     device = kwargs.get("device")
+    dtype = kwargs.get("dtype", None)
+    news_encoder = kwargs.get("news_encoder", None) or model.news_encoder
     if accelerator:
-        news_loader = accelerator.prepare_data_loader(news_loader)
+        news_loader = accelerator.prepare_data_loader(news_loader)  # shard news across processes
     bar = tqdm(news_loader, total=len(news_loader), disable=kwargs.get("disable_tqdm", True))
     for batch_dict in bar:
         bar.set_description(f"Get news embeddings: {gpu_stat()}")
         # load data to device
         batch_dict = load_batch_data(batch_dict, device)
-        # run news encoder
-        news_vec = model.news_encoder(batch_dict)["news_embed"]
-        # update news vectors
-        news_embeds.update(dict(zip(batch_dict["index"].cpu().tolist(), news_vec.cpu().numpy())))
+        # run news encoder, outputs are kept on device until all news are encoded
+        news_dict = news_encoder(batch_dict)
+        news_indices.append(batch_dict["index"])
+        # update news vectors and other cached outputs
+        for key in cache_keys:
+            if news_dict.get(key) is not None:
+                news_cache[key].append(news_dict[key] if dtype is None else news_dict[key].to(dtype))
     del batch_dict
-    return convert_dict_to_numpy(gather_dict(news_embeds, kwargs.get("num_processes", None)))
+    keys = [key for key in cache_keys if len(news_cache[key])]
+    gathered = gather_tensors(
+        [torch.cat(news_indices)] + [torch.cat(news_cache[key]) for key in keys], kwargs.get("num_processes", None)
+    )
+    news_indices, cache_matrices = gathered[0], {}
+    for key, values in zip(keys, gathered[1:]):
+        # row i of the matrix is the output of news with index i
+        matrix = values.new_empty((int(news_indices.max()) + 1,) + values.shape[1:])
+        matrix[news_indices] = values
+        cache_matrices[key] = matrix if kwargs.get("return_tensors", False) else matrix.cpu().numpy()
+    return cache_matrices
+
+
+def get_news_embeds(model, news_loader, **kwargs):
+    """
+    run news model and return news vectors (numpy matrix)
+    :param model: target running model
+    :param news_loader: news loader with all news data
+    :return: numpy matrix of news vectors (each row is a news vector)
+    """
+    return get_news_cache(model, news_loader, **kwargs)["news_embed"]
+
+
+def load_saved_weights(weight_path):
+    """
+    load weights saved during validation (return_weight) and split them by impression
+    :param weight_path: path of the saved npz file
+    :return: dictionary of lists, the i-th item of each list belongs to the i-th saved impression
+    """
+    with np.load(weight_path) as saved:  # close the file once all arrays are read
+        can_len, his_len = saved["candidate_length"], saved["history_length"]
+        metrics = [name for name in saved.files if name.startswith("results_")]
+        weight_dict = {
+            "impression_index": saved["impression_index"].tolist(),
+            "results": [dict(zip([m[len("results_"):] for m in metrics], scores))
+                        for scores in zip(*[saved[m] for m in metrics])],
+        }
+        for name in saved.files:
+            if name in ["impression_index", "candidate_length", "history_length"] or name in metrics:
+                continue
+            length = can_len if name in ["label", "pred_score"] or "candidate" in name else his_len
+            weight_dict[name] = np.split(saved[name], np.cumsum(length)[:-1])
+    return weight_dict
 
 
 def get_default_upath(**kwargs):